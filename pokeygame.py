@@ -4,10 +4,28 @@
 # Built-in modules
 import logging
 import time
+import sys
+import struct
 import curses
 import sqlite3
 import os
+import json
+import math
+import operator
+import random
+import itertools
+import threading
+import Queue
+import copy
+import collections
+import socket
+import asyncore
+import asynchat
+import ctypes
+import ctypes.util
 from curses import panel
+from array import array
+from multiprocessing import Pool
 
 # Custom modules
 import pokeyworks as fw
@@ -16,6 +34,43 @@ from resources.games.tiles import WorldTile
 from pokeywins import PokeyMenu
 from resources.games.world_generator import WorldGenerator
 
+def monotonic_clock():
+    """ Returns a wall time clock function that never goes backwards.
+    time.clock() is CPU time on Linux, and time.time() jumps with the
+    system clock, so neither suits frame or pause timing """
+
+    if hasattr(time,'monotonic'):
+        return time.monotonic
+
+    # CLOCK_MONOTONIC's id differs per platform
+    clock_ids = {'linux':1,'darwin':6,'freebsd':4}
+    platform = sys.platform.rstrip('0123456789')
+    if platform not in clock_ids:
+        return time.time
+    CLOCK_MONOTONIC = clock_ids[platform]
+
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec',ctypes.c_long),('tv_nsec',ctypes.c_long)]
+
+    try:
+        librt = ctypes.CDLL(ctypes.util.find_library('rt') or
+                            ctypes.util.find_library('c'),use_errno=True)
+        clock_gettime = librt.clock_gettime
+    except (OSError,AttributeError):
+        return time.time
+
+    def clock():
+        # Per call, the clock is read from server pool threads too
+        ts = timespec()
+        if clock_gettime(CLOCK_MONOTONIC,ctypes.byref(ts))!=0:
+            errno = ctypes.get_errno()
+            raise OSError(errno,os.strerror(errno))
+        return ts.tv_sec + ts.tv_nsec*1e-9
+
+    return clock
+
+game_clock = monotonic_clock()
+
 class PokeyGame(object):
 
     """ The PokeyGame class is intended to be a SuperClass
@@ -32,16 +87,39 @@ class PokeyGame(object):
         for item in [
                     ('test_mode',False),
                     ('turn',0),
+                    ('ticks',0),
                     ('time_paused',0),
-                    ('paused',False)
+                    ('paused',False),
+                    ('player',None),
+                    ('entities',[]),
+                    ('state','menu'),       # menu/prompt/map/play
+                    ('menu',None),          # MenuConfig on screen
+                    ('menu_pos',0),         # Highlighted menu item
+                    ('prompt',None),        # [conf attr,typed text]
+                    ('map_view',None),      # Floor/zoom/center of map
+                    ('map_return','menu')   # State left for the map
                     ]:
             setattr(self,*item)
 
+        # GameLoop hooks dispatch on self.state
+        self.key_handlers = {
+                            'menu':self.menu_key,
+                            'prompt':self.prompt_key,
+                            'map':self.map_key,
+                            'play':self.play_key
+                            }
+        self.renderers = {
+                        'menu':self.render_menu,
+                        'prompt':self.render_prompt,
+                        'map':self.render_map,
+                        'play':self.render_play
+                        }
+
         try:
             log_path = 'tmp/game_log.txt'
             os.stat(log_path)
         except OSError:
-            pokeyworks.mkdir('tmp')
+            fw.mkdir('tmp')
 
         self.logger = fw.setup_logger(
                                       self.name,
@@ -49,7 +127,89 @@ class PokeyGame(object):
                                       'tmp/game_log.txt'
                                       )
 
+        self.build_world()
+
+    def build_world(self):
+        """ Generates a world from the conf, its spawned creatures
+        become the entities and saves start over against it """
+
         self.world = PokeyWorld(self,self.conf,self.logger)
+        self.entities = self.world.spawned_creatures()
+        self.saves = PokeySave(
+                               self,
+                               self.database_path,
+                               self.logger,
+                               int(self.autosave_turns)
+                               )
+
+    def end_turn(self):
+        """ Advances the turn counter and triggers any due autosave """
+
+        self.turn += 1
+        self.saves.autosave(self.turn)
+
+    def load_game(self):
+        """ Replaces the running game with the save file: game state,
+        tile types, spawns, the player and entities with their status
+        effects """
+
+        self.logger.info('[*] Loading {}'.format(self.database_path))
+        saved = self.saves.load()
+        if not saved['game_state']:
+            self.logger.info('\tNo saved game found')
+            return False
+        restore = self.saves.restore
+        restore(self,saved['game_state'])
+
+        world = self.world
+        for loc,tile_type in saved['tiles'].items():
+            if world.in_bounds(loc):
+                world.set_tile(loc,tile_type)
+
+        creatures = world.load_spawns(saved['entities'],saved['spawns'])
+        restored = dict((ent.uid,ent) for ent in creatures)
+
+        self.player = None
+        self.entities = []
+        for uid,(cls_name,state) in sorted(saved['entities'].items()):
+            ent = restored.get(uid)
+            if ent is None:
+                if cls_name==Player.__name__:
+                    ent = Player([],state.get('name'))
+                elif cls_name==Entity.__name__:
+                    ent = Entity()
+                else:
+                    self.logger.error(
+                        '[*] Unknown entity {} in save'.format(cls_name))
+                    continue
+                restore(ent,state)
+
+            effects = saved['effects'].get(uid)
+            if effects:
+                ent.effects = [self.load_effect(e) for e in effects]
+
+            if isinstance(ent,Player):
+                self.player = ent
+            else:
+                self.entities.append(ent)
+        return True
+
+    def load_effect(self,state):
+        eff = StatusEffect(
+                            state.get('name'),
+                            state.get('attr'),
+                            state.get('delta')
+                            )
+        self.saves.restore(eff,state)
+        return eff
+
+    def failsafe(self):
+        """ Flushes a final save and stops the autosave thread """
+
+        try:
+            self.saves.save(wait=True)
+        finally:
+            self.saves.close()
 
     def toggle_pause(self,opt=None):
         """ Toggles the game's pause status, opt will allow the status
@@ -58,35 +218,188 @@ class PokeyGame(object):
         if opt is not None:
             if opt!=self.paused:
                 if self.paused:
-                    self.time_paused+=(time.clock()-self.pause_start)
+                    self.time_paused+=(game_clock()-self.pause_start)
                 else:
-                    self.pause_start=time.clock()
+                    self.pause_start=game_clock()
                 self.paused = opt
         else:
             if self.paused:
-                self.time_paused+=(time.clock()-self.pause_start)
+                self.time_paused+=(game_clock()-self.pause_start)
             else:
-                self.pause_start=time.clock()
+                self.pause_start=game_clock()
             self.paused = not self.paused
 
         self.logger.info('[*] Pause = {0}'.format(self.paused))
 
-    def show_menu(self):
-        """ Main menu control function to be run in the curses wrapper """
+    def elapsed(self):
+        """ Unpaused wall time since start_game, in seconds """
+
+        now = game_clock()
+        paused = self.time_paused
+        if self.paused:
+            paused += now-self.pause_start
+        return now-self.time_game_start-paused
+
+    def run_loop(self,screen):
+        """ Runs the fixed-tick GameLoop, for use in curses.wrapper """
+
+        self.stdscreen = screen
+        self.time_game_start = game_clock()
+        self.loop = GameLoop(
+                             self,
+                             int(self.tick_rate),
+                             int(self.max_frame_skip)
+                             )
+        self.loop.run()
+
+    def handle_key(self,key):
+        """ GameLoop input hook, called for each key pressed """
+        self.key_handlers[self.state](key)
+
+    def update(self,dt):
+        """ GameLoop simulation hook, called once per tick of dt secs.
+        Every ticks_per_turn ticks of play the turn ends """
+
+        if self.state!='play':
+            return
+        self.ticks += 1
+        if self.ticks % int(self.ticks_per_turn)==0:
+            self.end_turn()
+
+    def render(self,interp):
+        """ GameLoop render hook, interp is the fraction of a tick
+        elapsed since the last update """
+
+        self.stdscreen.erase()
+        self.renderers[self.state]()
+        self.stdscreen.refresh()
+
+    def add_line(self,row,text,attr=0):
+        """ Writes text on row if it fits, clipped to the screen """
+
+        rows,cols = self.stdscreen.getmaxyx()
+        if 0<=row<rows:
+            self.stdscreen.addstr(row,0,text[:cols-1],attr)
+
+    def show_menu(self,menu_type=None):
+        """ Opens a MenuConfig menu, the main menu by default """
+
+        if menu_type is None:
+            menu_type = MenuConfig.main_menu
         curses.curs_set(0)
-        self.main_menu.display()
+        self.menu = MenuConfig(self,menu_type)
+        self.menu_pos = 0
+        self.state = 'menu'
+
+    def menu_key(self,key):
+        items = self.menu.menu_items
+        if key in (curses.KEY_UP,ord('k')):
+            self.menu_pos = (self.menu_pos-1) % len(items)
+        elif key in (curses.KEY_DOWN,ord('j')):
+            self.menu_pos = (self.menu_pos+1) % len(items)
+        elif key in (curses.KEY_ENTER,10,13):
+            item = items[self.menu_pos]
+            item[1](*item[2:])
+
+    def render_menu(self):
+        self.add_line(0,self.menu.title,curses.A_BOLD)
+        for i,item in enumerate(self.menu.menu_items):
+            attr = curses.A_REVERSE if i==self.menu_pos else 0
+            self.add_line(i+2,'{0}. {1}'.format(i+1,item[0]),attr)
+
+    def set_x(self):
+        self.ask('dim_x')
+
+    def set_y(self):
+        self.ask('dim_y')
+
+    def set_z(self):
+        self.ask('dim_z')
+
+    def ask(self,attr):
+        """ Prompts for a positive integer conf value """
+        self.prompt = [attr,'']
+        self.state = 'prompt'
+
+    def prompt_key(self,key):
+        attr,text = self.prompt
+        if ord('0')<=key<=ord('9'):
+            self.prompt[1] = text+chr(key)
+        elif key in (curses.KEY_BACKSPACE,127,8):
+            self.prompt[1] = text[:-1]
+        elif key in (curses.KEY_ENTER,10,13):
+            if text and int(text) > 0:
+                setattr(self.conf,attr,text)
+                self.logger.info('[*] {0} = {1}'.format(attr,text))
+            self.show_menu(MenuConfig.map_size_menu)
+        elif key==27:
+            self.show_menu(MenuConfig.map_size_menu)
+
+    def render_prompt(self):
+        attr,text = self.prompt
+        self.add_line(0,'{0} ({1}):'.format(attr,getattr(self.conf,attr)))
+        self.add_line(1,'> '+text)
+        self.add_line(3,'enter sets, esc cancels')
+
+    def generate_map(self):
+        """ Replaces the world with a new one built from the conf """
+
+        self.logger.info('[*] Generating a new world')
+        self.saves.close()
+        self.build_world()
+        self.turn = 0
+        self.show_menu(MenuConfig.world_menu)
+
+    def begin_play(self):
+        if self.paused:
+            self.toggle_pause()
+        self.state = 'play'
+
+    def continue_game(self):
+        """ Loads the saved game and plays it """
+        if self.load_game():
+            self.begin_play()
+
+    def quit_game(self):
+        self.loop.stop()
+
+    def play_key(self,key):
+        if key==ord('p'):
+            self.toggle_pause()
+        elif key==ord('m'):
+            self.curses_print_map()
+        elif key==ord('q'):
+            # Menu time is not game time
+            if not self.paused:
+                self.toggle_pause()
+            self.show_menu()
+
+    def render_play(self):
+        rows,cols = self.stdscreen.getmaxyx()
+        status = 'Turn {0}{1}  [p]ause [m]ap [q]menu'.format(
+                            self.turn,' (paused)' if self.paused else '')
+        self.add_line(0,status)
+        living = len([e for e in self.entities if e.living])
+        self.add_line(1,'{0} creatures about'.format(living))
+        self.draw_map(
+                    self.stdscreen,
+                    0,
+                    0,
+                    [self.world.dim_x//2,self.world.dim_y//2],
+                    2
+                    )
 
     def start_game(self):
-        self.time_game_start = time.clock()
         self.logger.info("[*] Starting Game")
-        curses.wrapper(self.show_menu)
+        curses.wrapper(self.play)
 
     def play(self,screen):
-        self.main_menu = PokeyMenu(MenuConfig(self,0),scrn)
-        self.world_menu = PokeyMenu(MenuConfig(self,1),scrn)
-        self.map_size_menu = PokeyMenu(MenuConfig(self,2),scrn)
+        """ Opens the main menu and runs the game on the GameLoop """
+
         self.stdscreen = screen
+        screen.keypad(1)
         self.show_menu()
+        self.run_loop(screen)
 
     def config_init(self):
         """ Pulls certain values, if they exist, from the game config """
@@ -98,6 +411,15 @@ class PokeyGame(object):
             ('log_path',False),          # Turn on logging (w/path)
             ('log_lvl',logging.DEBUG),   # Set log level
 
+            # Save Options
+            ('database_path','tmp/game.db'),  # SQLite save-game file
+            ('autosave_turns',10),       # Autosave every N turns (0=off)
+
+            # Game Loop Options
+            ('tick_rate',20),            # Simulation ticks per second
+            ('max_frame_skip',5),        # Ticks run before forcing a render
+            ('ticks_per_turn',20),       # Ticks per game turn
+
             # World Generation Options
             ('flex_limit',3)             # Sets the maximum variance
 
@@ -130,34 +452,148 @@ class PokeyGame(object):
                 sys.exit(1)
 
     def curses_print_map(self):
-        """ Prints the map grid (Starts on floor 1) """
-        map_window = self.stdscreen.subwin(5,5)
-        map_keypad = map_window.keypad(1)
-        map_panel = panel.new_panel(map_window)
+        """ Opens the map view on floor 1, zoomed out far enough for
+        the floor to fit.  +/- zoom down to 1:1, arrows scroll, </>
+        change floor, q returns to where the map was opened from """
+
+        rows,cols = self.stdscreen.getmaxyx()
+        self.map_view = {
+                        'z':0,
+                        'level':self.world.pyramid.level_for(cols-1,rows-2),
+                        # View center in tile coordinates, kept across
+                        # zoom levels
+                        'center':[self.world.dim_x//2,self.world.dim_y//2]
+                        }
+        self.map_return = self.state
+        self.state = 'map'
+
+    def map_key(self,key):
+        view = self.map_view
+        pyramid = self.world.pyramid
+        scroll = {
+                curses.KEY_LEFT:(0,-1),
+                curses.KEY_RIGHT:(0,1),
+                curses.KEY_UP:(1,-1),
+                curses.KEY_DOWN:(1,1)
+                }
+        dims = (self.world.dim_x,self.world.dim_y)
+
+        if key==ord('q'):
+            self.state = self.map_return
+        elif key==ord('+'):
+            view['level'] = max(0,view['level']-1)
+        elif key==ord('-'):
+            view['level'] = min(pyramid.top_level,view['level']+1)
+        elif key==ord('>'):
+            view['z'] = min(self.world.dim_z-1,view['z']+1)
+        elif key==ord('<'):
+            view['z'] = max(0,view['z']-1)
+        elif key in scroll:
+            # A quarter screen per key press, at the current zoom
+            rows,cols = self.stdscreen.getmaxyx()
+            axis,sign = scroll[key]
+            step = max(1,(cols,rows)[axis]//4)<<view['level']
+            center = view['center']
+            center[axis] = max(0,min(dims[axis]-1,center[axis]+sign*step))
+
+    def render_map(self):
+        view = self.map_view
+        rows,cols = self.stdscreen.getmaxyx()
+        self.draw_map(self.stdscreen,view['z'],view['level'],view['center'])
+        self.add_line(rows-1,'floor {0}/{1}  1:{2}  +/- < > arrows q'.format(
+                            view['z']+1,self.world.dim_z,1<<view['level']))
+
+    def draw_map(self,window,z,level,center,top_row=0):
+        """ Draws floor z from pyramid level (2**level tiles per cell)
+        around center (x,y tiles) from top_row down, constant work per
+        screen cell whatever the floor size """
+        rows,cols = window.getmaxyx()
+        pyramid = self.world.pyramid
+        width,height = pyramid.level_dims(level)
+        view_w = min(width,cols-1)
+        view_h = min(height,rows-1-top_row)
+
+        # Top left cell of the view, clamped to the floor
+        left = max(0,min(width-view_w,(center[0]>>level)-view_w//2))
+        top = max(0,min(height-view_h,(center[1]>>level)-view_h//2))
+
+        for row in range(view_h):
+            cy = top+row
+            line = ''.join(pyramid.cell_char(z,level,cx,cy)
+                            for cx in range(left,left+view_w))
+            window.addstr(top_row+row,0,line)
+
+class GameLoop(object):
+
+    """ Fixed-tick game loop.  The simulation steps at tick_rate on the
+    monotonic clock whatever the render speed, input is polled without
+    blocking, and renders are skipped rather than letting a slow frame
+    hold back the simulation """
+
+    def __init__(self,game,tick_rate=20,max_frame_skip=5):
 
-        map_panel.update_panels()
-        map_panel.top()
-        map_panel.show()
-        map_window.clear()
+        self.game = game
+        self.tick_len = 1.0/tick_rate
+        self.max_frame_skip = max_frame_skip
+        self.running = False
+        self.ticks = 0
+        self.frames = 0
+
+    def poll_input(self):
+        screen = self.game.stdscreen
+        key = screen.getch()
+        while key!=-1:
+            self.game.handle_key(key)
+            key = screen.getch()
+
+    def run(self):
+        game = self.game
+        game.stdscreen.nodelay(1)
+        self.running = True
+        next_tick = game_clock()
+
+        while self.running:
+            self.poll_input()
+
+            if game.paused:
+                # Keep polling and drawing so the game can be resumed or
+                # its menus used, and restart the tick schedule so
+                # paused time is never caught up
+                game.render(0.0)
+                self.frames += 1
+                time.sleep(self.tick_len)
+                next_tick = game_clock()
+                continue
 
-        x = 0; y=0; z=0
+            steps = 0
+            while game_clock() >= next_tick and steps < self.max_frame_skip:
+                game.update(self.tick_len)
+                next_tick += self.tick_len
+                self.ticks += 1
+                steps += 1
+                self.poll_input()
 
-        # Print map phase
-        draw_map(self,[x,y,z])
+            now = game_clock()
+            if now >= next_tick+self.tick_len*self.max_frame_skip:
+                # Too far behind to catch up, drop the backlog
+                game.logger.debug('\tGameLoop dropped {} ticks'.format(
+                            int((now-next_tick)/self.tick_len)))
+                next_tick = now
 
-        def draw_map(game,loc):
-            grid = game.world.grid
+            game.render(min(1.0,(now+self.tick_len-next_tick)/self.tick_len))
+            self.frames += 1
 
-            z = loc[2]      # Load the current floor (z)
+            idle = next_tick-game_clock()
+            if idle > 0:
+                time.sleep(idle)
 
-            for x in range(game.conf.x_dim):
-                for y in range(game.conf.y_dim):
-                    # Draw a map here!
-                    pass
+    def stop(self):
+        self.running = False
 
 class MenuConfig(object):
 
-    """ Curses Menu configuration class """
+    """ Curses Menu configuration class.  Items are (label,function,
+    *args), PokeyGame calls function(*args) when one is selected """
 
     main_menu = 0
     world_menu = 1
@@ -167,50 +603,68 @@ class MenuConfig(object):
 
         if menu_type==MenuConfig.main_menu:
             # Main menu options
+            title = 'Main Menu'
             return_items = [
-                ('start game',game.play),
-                ('world generation menu',game.world_menu.display)
+                ('start game',game.begin_play),
+                ('load game',game.continue_game),
+                ('world generation menu',game.show_menu,
+                                            MenuConfig.world_menu),
+                ('quit',game.quit_game)
                 ]
 
         elif menu_type==MenuConfig.world_menu:
             # World Generation Options
+            title = 'World Generation'
             return_items = [
-                ('set map size',game.map_size_menu.display,None),
-                ('generate_map',game.generate_map),
+                ('set map size',game.show_menu,MenuConfig.map_size_menu),
+                ('generate map',game.generate_map),
                 ('print map',game.curses_print_map),
-                ('main menu',game.main_menu.display)
+                ('main menu',game.show_menu,MenuConfig.main_menu)
                 ]
         elif menu_type==MenuConfig.map_size_menu:
             # Set x / y / z Parameters
+            title = 'Map Size'
             return_items = [
                 ('set x ({0})'.format(game.conf.dim_x),game.set_x),
                 ('set y ({0})'.format(game.conf.dim_y),game.set_y),
                 ('set z ({0})'.format(game.conf.dim_z),game.set_z),
-                ('back',game.world_menu.display)
+                ('back',game.show_menu,MenuConfig.world_menu)
                 ]
         else:
             game.handle_error(
                 AssertionError('Invalid Menu Type!:{0}'.format(menu_type))
                 )
+            title = ''
             return_items = False
 
+        self.title = title
         self.menu_items = return_items
 
 class PokeyWorld:
     """ The World object at the center of every game, contains a GameGrid """
 
-    def __init__(self,game,conf,logger):
+    def __init__(self,game,conf,logger,world_gen=None):
         self.logger = logger
         self.game = game
         self.conf = conf
         self.logger.info("[*] Beginning PokeyWorld Generation")
         self.set_dims(conf)
-        self.world_gen = self.grid_init_check()
+        # A WorldGenerator may be passed in, already built elsewhere
+        if world_gen is None:
+            world_gen = self.grid_init_check()
+        self.world_gen = world_gen
 
         self.logger.debug("\tChecking dimensions against template...")
         assert self.check_dimensions(), 'Dimension conflict! Check your conf'
         self.logger.debug("\tDimensions passed!")
 
+        self.journal = TileJournal(self.dim_z)
+        self.pyramid = None
+        self.spawner = None
+        self.spawns = {}        # kind -> [Spawn or Creature]
+        self.occupants = {}     # (x,y,z) -> Spawn or Creature
+        self.spawn_rules = dict((r.kind,r) for r in SpawnEngine.default_rules)
+
         self.populate_tiles()
 
     def populate_tiles(self):
@@ -222,7 +676,7 @@ class PokeyWorld:
         # grid(x,y,z)[2]: The tile object
 
         self.t_count = 0    # Tile count, increment for each tile added
-        self.build_start = time.clock()
+        self.build_start = game_clock()
         self.logger.info("[*] Starting world building script")
 
         script_list = [
@@ -243,23 +697,25 @@ class PokeyWorld:
 
         self.logger.info("[*] World building script completed")
         self.logger.debug("\tTiles Placed : {}".format(self.t_count))
-        build_time = time.clock()-self.build_start
+        build_time = game_clock()-self.build_start
         self.logger.debug("\tTook {}s".format(build_time))
-        self.logger.debug("\tTiles/s : {}".format(t_count/build_time))
+        self.logger.debug("\tTiles/s : {}".format(self.t_count/build_time))
+
+        self.pyramid = MapPyramid(self)
+        self.logger.debug("\tMap pyramid levels : {}".format(
+                                                    self.pyramid.top_level))
 
     def build_rooms(self):
         return self.room_fill(WorldTile.dungeon,tiles.Dungeon)
 
     def room_fill(self,tile_type,tile,replace=None):
         try:
-            for z in self.dim_z:
-                for y in self.dim_y:
-                    for x in self.dim_x:
+            for z in range(self.dim_z):
+                for y in range(self.dim_y):
+                    for x in range(self.dim_x):
                         if len(self.world_gen.grid[x,y,z])==2:
                             if self.world_gen.grid[x,y,z][0]==tile_type:
-                                self.world_gen.grid[x,y,z][2]==tile()
-                                if replace is not None:
-                                    self.world_gen.grid[x,y,z][0]=replace
+                                self.set_tile((x,y,z),replace,tile())
                                 self.t_count += 1
             retval = True
         except:
@@ -279,20 +735,102 @@ class PokeyWorld:
         # Build a door here and lock it
         self.place_door(center,True)
         # Fill the room with Boss Room tiles
-        self.fill_room(center,WorldTile.boss)
-
-    def build_traps():
+        self.fill_boss_room(center,WorldTile.boss)
         return True
 
-    def build_chests():
-        return True
+    def build_traps(self):
+        return self.spawn('traps')
 
-    def build_mobs():
+    def build_chests(self):
+        return self.spawn('chests')
+
+    def build_mobs(self):
+        return self.spawn('mobs')
+
+    def build_npcs(self):
+        return self.spawn('npcs')
+
+    def spawn(self,kind):
+        """ Places spawns of kind per its SpawnRule, stored in
+        self.spawns[kind] and by position in self.occupants.  Living
+        kinds are Creature entities, the rest are inert Spawns """
+
+        # Free tiles are indexed once, after rooms/halls/doors are built
+        if self.spawner is None:
+            self.spawner = SpawnEngine(self)
+
+        rule = self.spawn_rules[kind]
+        cls = Creature if rule.living else Spawn
+        placed = [cls(kind,loc) for loc in self.spawner.spawn(rule)]
+        self.add_spawns(kind,placed)
+        self.logger.debug("\t{} {} placed".format(len(placed),kind))
         return True
 
-    def build_npcs():
+    def add_spawns(self,kind,placed):
+        self.spawns.setdefault(kind,[]).extend(placed)
+        for ent in placed:
+            self.set_tile((ent.x,ent.y,ent.z),occupant=ent)
+
+    def occupant_at(self,loc):
+        """ The Spawn or Creature at loc, or None """
+        return self.occupants.get(tuple(loc))
+
+    def vacate(self,loc):
+        """ Removes the occupant at loc (a looted chest, a sprung trap,
+        a dead mob), returns it or None if loc was empty """
+
+        loc = tuple(loc)
+        ent = self.occupants.get(loc)
+        if ent is not None:
+            self.set_tile(loc,vacate=True)
+            self.spawns[ent.kind].remove(ent)
+        return ent
+
+    def move_occupant(self,loc,new_loc):
+        """ Moves the occupant at loc to new_loc if that is free,
+        returns True if it moved """
+
+        loc,new_loc = tuple(loc),tuple(new_loc)
+        ent = self.occupants.get(loc)
+        if ent is None or new_loc in self.occupants:
+            return False
+        self.set_tile(loc,vacate=True)
+        ent.x,ent.y,ent.z = new_loc
+        self.set_tile(new_loc,occupant=ent)
         return True
 
+    def spawned_creatures(self):
+        """ The living spawns, these are saved and updated as entities """
+        return [ent for kind in sorted(self.spawns)
+                    for ent in self.spawns[kind]
+                    if isinstance(ent,Creature)]
+
+    def inert_spawns(self):
+        return [ent for kind in sorted(self.spawns)
+                    for ent in self.spawns[kind]
+                    if isinstance(ent,Spawn)]
+
+    def load_spawns(self,entities,spawns):
+        """ Replaces the spawns with those from PokeySave.load(), the
+        Creature entries of its entities dict and its spawns dict.
+        Returns the restored Creatures """
+
+        for loc in list(self.occupants):
+            self.vacate(loc)
+
+        for uid,(cls_name,state) in sorted(entities.items()):
+            if cls_name!=Creature.__name__:
+                continue
+            ent = Creature(state['kind'],(state['x'],state['y'],state['z']))
+            for k,v in state.items():
+                setattr(ent,k,v)
+            self.add_spawns(ent.kind,[ent])
+
+        for loc,kind in sorted(spawns.items()):
+            self.add_spawns(kind,[Spawn(kind,loc)])
+
+        return self.spawned_creatures()
+
     def place_door(self,position,locked=False):
 
         assert isinstance(position,tuple), 'Invalid pos: {}'.format(position)
@@ -302,46 +840,94 @@ class PokeyWorld:
             door = tiles.LockedDoor
         else:
             door = tiles.Door
-        self.world_gen.grid[position][2]=door()
+        self.set_tile(position,tile=door())
 
     def fill_boss_room(self,center,tile):
         # Detects the room size and then loops, filling
         # a room in world_gen.grid[2] 
 
-        c = center
-        x,y,z = c
+        x,y,z = center
 
-        for i in range(self.world_gen.room_variance):
-            for t in [(-i,i,0),(i,i,0),(-i,-i,0),(i,-i,0)]:
-                this_test = (c[0]+t[0],c[1]+t[1],c[2]+t[2])
-                if self.world_gen.grid[this_test]==WorldTile.dungeon:
-                    result = True
-                else:
-                    result = False
-                if not result:
-                    room_size = i-1
-                    break
-            if not result:
+        # The center holds the exit, so the room grows from ring 1 until
+        # a corner leaves the dungeon (or the grid)
+        room_size = 0
+        for i in range(1,self.world_gen.room_variance+1):
+            corners = [(x-i,y+i,z),(x+i,y+i,z),(x-i,y-i,z),(x+i,y-i,z)]
+            if not all(self.in_bounds(t) and
+                        self.world_gen.grid[t][0]==WorldTile.dungeon
+                        for t in corners):
                 break
+            room_size = i
 
         assert room_size > 0, 'Boss room size cannot be zero!'
         assert room_size <= self.world_gen.room_variance, \
                             'Boss room cannot be larger than room_variance'
 
         tile = tiles.BossRoom
-        for y_offset in range(-room_size,room_size):
-            for x_offset in range(-room_size,room_size):
+        for y_offset in range(-room_size,room_size+1):
+            for x_offset in range(-room_size,room_size+1):
                 this_point = (
-                            min(self.dim_x,x+x_offset),
-                            min(self.dim_y,y+y_offset),
+                            max(0,min(self.dim_x-1,x+x_offset)),
+                            max(0,min(self.dim_y-1,y+y_offset)),
                             z
                             )
                 if self.world_gen.grid[this_point][0]==WorldTile.dungeon:
-                    self.world_gen.grid[this_point][2]=tile()
                     # Change the map char to avoid overwriting later
-                    self.world_gen.grid[this_point][0]=WorldTile.boss
+                    self.set_tile(this_point,WorldTile.boss,tile())
                     self.t_count += 1
 
+    def in_bounds(self,loc):
+        x,y,z = loc
+        return 0<=x<self.dim_x and 0<=y<self.dim_y and 0<=z<self.dim_z
+
+    def set_tile(
+                self,
+                loc,
+                tile_type=None,
+                tile=None,
+                occupant=None,
+                vacate=False
+                ):
+        """ The single write path for the grid.  Sets the map char,
+        tile object and/or occupant at loc, or clears the occupant with
+        vacate, journals the change and keeps the pyramid and spawn
+        occupancy current """
+
+        cell = self.world_gen.grid[loc]
+        old_type = cell[0]
+        changed = 0
+
+        if tile_type is not None and tile_type!=old_type:
+            cell[0] = tile_type
+            changed |= TileJournal.type_changed
+            if self.pyramid is not None:
+                self.pyramid.update(loc,old_type,tile_type)
+        else:
+            tile_type = old_type
+
+        if tile is not None:
+            if len(cell)==2:
+                cell.append(tile)
+                changed |= TileJournal.tile_changed
+            elif cell[2] is not tile:
+                cell[2] = tile
+                changed |= TileJournal.tile_changed
+
+        if occupant is not None and self.occupants.get(loc) is not occupant:
+            self.occupants[loc] = occupant
+            changed |= TileJournal.occupant_changed
+            if self.spawner is not None:
+                self.spawner.mark(loc,1)
+        elif vacate and loc in self.occupants:
+            del self.occupants[loc]
+            changed |= TileJournal.occupant_changed
+            if self.spawner is not None:
+                self.spawner.mark(loc,0)
+
+        # Writes which change nothing are not journaled
+        if changed:
+            self.journal.record(loc,old_type,tile_type,changed)
+
     def set_dims(self,conf):
         self.logger.debug("\tGrabbing map dimensions")
         self.dim_x = int(conf.dim_x)
@@ -380,14 +966,33 @@ class PokeyWorld:
 
     def grid_insert(self,tile,loc):
         try:
-            x,y,z = loc[0],loc[1],loc[2]
-            self.grid[x,y,z][2]=tile
+            self.set_tile((loc[0],loc[1],loc[2]),tile=tile)
         except Exception as e:
             self.game.handle_error(e)
             return False
         else:
             return True
 
+    def iter_floors(self,floors=None):
+        """ Yields (z,rows) per floor, rows yielding (y,[tile types])
+        one row at a time, straight from the grid """
+
+        if floors is None:
+            floors = range(self.dim_z)
+        for z in floors:
+            yield z,self.iter_rows(z)
+
+    def iter_rows(self,z):
+        return grid_rows(self.world_gen.grid,z,self.dim_x,self.dim_y)
+
+    def export(self,out='-',fmt='jsonl',tile_types=None):
+        """ Streams the world to out (a path, a file, or - for stdout),
+        tile_types is the binary type table (default: WorldTile's) """
+
+        dims = (self.dim_x,self.dim_y,self.dim_z)
+        exporter = WorldExport(out,fmt,tile_types)
+        return exporter.write(dims,self.iter_floors())
+
     def get_tile(self,loc):
         try:
             assert len(grid[loc[0],loc[1],loc[2]])==3, \
@@ -410,33 +1015,1412 @@ class PokeyWorld:
         #except AssertionError:
             #raise
 
-        debug = True if self.conf.debug=='1' else False
-        silent = True if self.conf.silent=='1' else False
-        verbose = True if self.conf.verbose=='1' else False
-        post_check = True if self.conf.auto_check=='1' else False
+        opts = world_gen_opts(self.conf)
+        dims = (self.dim_x,self.dim_y,self.dim_z)
 
         max_trys = 3
         while True:
             try:
-                world_gen=WorldGenerator(
-                                        debug,silent,
-                                        False,None,None,
-                                        self.dim_x,
-                                        self.dim_y,
-                                        self.dim_z,
-                                        0,verbose,self.logger,2,
-                                        post_check,
-                                        self.conf.path_alg
-                                        )
+                world_gen = new_world_gen(opts,dims,self.logger)
             except:
                 if max_trys > 0:
                     raise
                 else:
                     continue
             else:
-                print world_gen
+                self.logger.debug("\tWorld generated : {}".format(world_gen))
                 return world_gen
 
+class WorldExport(object):
+
+    """ Streams a world as JSON Lines or packed binary, a row at a time.
+    floors may be any iterable of (z,rows) such as PokeyWorld.iter_floors,
+    or generate_floors which builds each floor on demand, so memory use
+    does not grow with the number of floors.
+
+    jsonl   : a {"dim_x","dim_y","dim_z"} header line, then one
+              {"z","y","tiles"} line per row, tiles holding the tile
+              type values themselves
+    binary  : header_fmt header, then type_fmt plus the JSON encoded
+              type value for each entry of the type table, whose order
+              gives each type its byte code.  Then per row row_fmt (z,y)
+              followed by dim_x bytes, one code per tile """
+
+    magic = 'PKWX'
+    version = 2
+    header_fmt = '<4sBHHHB'     # magic,version,dim_x,dim_y,dim_z,types
+    type_fmt = '<H'             # length of the JSON type value
+    row_fmt = '<HH'
+
+    formats = ['jsonl','binary']
+
+    def __init__(self,out='-',fmt='jsonl',tile_types=None):
+
+        assert fmt in self.formats, 'Invalid export format : {}'.format(fmt)
+        self.out = out
+        self.fmt = fmt
+        self.rows = 0
+
+        if fmt=='binary':
+            if tile_types is None:
+                tile_types = self.world_tile_types()
+            assert 0 < len(tile_types) <= 255, \
+                        'Binary export supports 1-255 tile types'
+            self.tile_types = tile_types
+            self.codes = dict((t,chr(i)) for i,t in enumerate(tile_types))
+
+    @staticmethod
+    def world_tile_types():
+        """ The tile type values defined on WorldTile, in name order """
+
+        types = []
+        for name,value in sorted(vars(WorldTile).items()):
+            if name.startswith('_') or callable(value):
+                continue
+            if value not in types:
+                types.append(value)
+        return types
+
+    def write(self,dims,floors):
+        """ Writes every row of floors, returns the row count """
+
+        if self.out=='-':
+            self.stream(sys.stdout,dims,floors)
+        elif isinstance(self.out,basestring):
+            mode = 'wb' if self.fmt=='binary' else 'w'
+            with open(self.out,mode) as fh:
+                self.stream(fh,dims,floors)
+        else:
+            self.stream(self.out,dims,floors)
+        return self.rows
+
+    def stream(self,fh,dims,floors):
+        dim_x,dim_y,dim_z = dims
+
+        if self.fmt=='binary':
+            fh.write(struct.pack(self.header_fmt,self.magic,self.version,
+                                dim_x,dim_y,dim_z,len(self.tile_types)))
+            for tile_type in self.tile_types:
+                value = json.dumps(tile_type)
+                fh.write(struct.pack(self.type_fmt,len(value)))
+                fh.write(value)
+        else:
+            fh.write(json.dumps({'dim_x':dim_x,'dim_y':dim_y,'dim_z':dim_z},
+                                        sort_keys=True))
+            fh.write('\n')
+
+        for z,rows in floors:
+            for y,row in rows:
+                assert len(row)==dim_x, 'Bad row length : {}'.format((z,y))
+                if self.fmt=='binary':
+                    fh.write(struct.pack(self.row_fmt,z,y))
+                    fh.write(self.encode_row(row,z,y))
+                else:
+                    fh.write(json.dumps({'z':z,'y':y,'tiles':row},
+                                        sort_keys=True))
+                    fh.write('\n')
+                self.rows += 1
+        fh.flush()
+
+    def encode_row(self,row,z,y):
+        try:
+            return ''.join(self.codes[t] for t in row)
+        except KeyError as e:
+            raise AssertionError('Tile type {0!r} at row {1} is not in '
+                        'the export type table'.format(e.args[0],(z,y)))
+
+class TileJournal(object):
+
+    """ Ordered log of grid changes with per floor dirty regions.
+    Subscribers read only the changes made since their last sync, and
+    entries are dropped once every subscriber has seen them, or once
+    there are more than max_entries """
+
+    region_size = 16        # Dirty regions are region_size square tiles
+    max_entries = 100000    # Past this a lagging subscriber must resync
+
+    # Entry change flags, what a write altered at its loc
+    type_changed = 1
+    tile_changed = 2
+    occupant_changed = 4
+
+    def __init__(self,dim_z):
+
+        self.seq = 0
+        self.dropped = 0    # Last seq dropped before everyone had seen it
+        # (seq,loc,old_type,new_type,changed flags)
+        self.entries = collections.deque()
+        self.dirty = [{} for z in range(dim_z)] # (rx,ry) -> last seq
+        self.cursors = {}                    # subscriber -> last seq seen
+
+    def record(self,loc,old_type,new_type,changed):
+        self.seq += 1
+        x,y,z = loc
+        self.dirty[z][x//self.region_size,y//self.region_size] = self.seq
+        if self.cursors:
+            self.entries.append((self.seq,loc,old_type,new_type,changed))
+            if len(self.entries) > self.max_entries:
+                self.dropped = self.entries.popleft()[0]
+
+    def subscribe(self,name):
+        """ Registers name, it will see changes from now on """
+
+        self.cursors[name] = self.seq
+
+    def unsubscribe(self,name):
+        del self.cursors[name]
+        self.trim()
+
+    def changes_since(self,name):
+        """ Returns (entries,dirty) for name since its last sync, where
+        dirty is {z:set of (rx,ry) regions}, and advances its cursor.
+        entries is None if some were dropped unseen, the subscriber
+        should then resync from the grid (or just the dirty regions) """
+
+        cursor = self.cursors[name]
+        if cursor < self.dropped:
+            entries = None
+        else:
+            entries = [e for e in self.entries if e[0] > cursor]
+
+        dirty = {}
+        for z,regions in enumerate(self.dirty):
+            changed = set(r for r,seq in regions.items() if seq > cursor)
+            if changed:
+                dirty[z] = changed
+
+        self.cursors[name] = self.seq
+        self.trim()
+        return entries,dirty
+
+    def trim(self):
+        oldest = min(self.cursors.values()) if self.cursors else self.seq
+        while self.entries and self.entries[0][0] <= oldest:
+            self.entries.popleft()
+
+    def region_bounds(self,region):
+        """ Tile (x0,y0,x1,y1) covered by a region, end exclusive """
+
+        rx,ry = region
+        size = self.region_size
+        return rx*size,ry*size,(rx+1)*size,(ry+1)*size
+
+class MapPyramid(object):
+
+    """ Mipmap style summaries of each floor.  Level k holds one cell
+    per 2**k x 2**k block of tiles with per-type counts, the dominant
+    tile type and flags, and is updated incrementally per tile change """
+
+    contains_exit = 1
+    contains_boss = 2
+
+    flag_types = [
+                (contains_exit,WorldTile.exit_point),
+                (contains_boss,WorldTile.boss)
+                ]
+
+    # Drawn for tile types whose own text is not one printable char
+    spare_glyphs = 'abcdefghijklmnopqrstuvwxyz0123456789'
+
+    def __init__(self,world):
+
+        self.dim_x = world.dim_x
+        self.dim_y = world.dim_y
+        self.dim_z = world.dim_z
+        self.grid = world.world_gen.grid
+        # Tile type -> the single character drawn for it
+        self.glyphs = {}
+
+        self.top_level = 0
+        while (self.dim_x-1)>>self.top_level or (self.dim_y-1)>>self.top_level:
+            self.top_level += 1
+
+        # counts/dominant/flags[z][level] : flat lists indexed cy*width+cx,
+        # level 0 is read straight from the grid
+        self.counts = []
+        self.dominant = []
+        self.flags = []
+        for z in range(self.dim_z):
+            self.build_floor(z)
+
+    def level_dims(self,level):
+        step = 1<<level
+        return (self.dim_x+step-1)>>level,(self.dim_y+step-1)>>level
+
+    def level_for(self,width,height):
+        """ Lowest level at which a whole floor fits width x height """
+
+        for level in range(self.top_level+1):
+            w,h = self.level_dims(level)
+            if w <= width and h <= height:
+                return level
+        return self.top_level
+
+    def build_floor(self,z):
+        grid = self.grid
+        counts = [None]
+        dominant = [None]
+        flags = [None]
+
+        for level in range(1,self.top_level+1):
+            width,height = self.level_dims(level)
+            cells = [{} for i in range(width*height)]
+
+            if level==1:
+                for y in range(self.dim_y):
+                    row = (y>>1)*width
+                    for x in range(self.dim_x):
+                        c = cells[row+(x>>1)]
+                        t = grid[x,y,z][0]
+                        c[t] = c.get(t,0)+1
+            else:
+                child_w,child_h = self.level_dims(level-1)
+                for cy in range(child_h):
+                    row = (cy>>1)*width
+                    for cx in range(child_w):
+                        c = cells[row+(cx>>1)]
+                        for t,n in counts[-1][cy*child_w+cx].items():
+                            c[t] = c.get(t,0)+n
+
+            counts.append(cells)
+            dominant.append([max(c,key=c.get) for c in cells])
+            flags.append([self.cell_flags(c) for c in cells])
+
+        self.counts.append(counts)
+        self.dominant.append(dominant)
+        self.flags.append(flags)
+
+    def cell_flags(self,cell_counts):
+        flags = 0
+        for flag,tile_type in self.flag_types:
+            if cell_counts.get(tile_type):
+                flags |= flag
+        return flags
+
+    def update(self,loc,old_type,new_type):
+        """ Moves one tile's count from old_type to new_type on every
+        level, O(levels) per change """
+
+        if old_type==new_type:
+            return
+
+        x,y,z = loc
+        for level in range(1,self.top_level+1):
+            width = self.level_dims(level)[0]
+            i = (y>>level)*width+(x>>level)
+            c = self.counts[z][level][i]
+
+            c[old_type] -= 1
+            if not c[old_type]:
+                del c[old_type]
+            c[new_type] = c.get(new_type,0)+1
+
+            self.dominant[z][level][i] = max(c,key=c.get)
+            self.flags[z][level][i] = self.cell_flags(c)
+
+    def summary(self,z,level,cx,cy):
+        """ Returns (dominant tile type,flags) for a cell """
+
+        if level==0:
+            t = self.grid[cx,cy,z][0]
+            return t,self.cell_flags({t:1})
+        i = cy*self.level_dims(level)[0]+cx
+        return self.dominant[z][level][i],self.flags[z][level][i]
+
+    def glyph(self,tile_type):
+        """ One character per tile type, so every map cell is one
+        column wide whatever the type's value """
+
+        try:
+            return self.glyphs[tile_type]
+        except KeyError:
+            pass
+
+        if isinstance(tile_type,basestring):
+            text = tile_type
+        else:
+            text = str(tile_type)
+        used = set(self.glyphs.values())
+
+        if len(text)==1 and ' '<=text<='~' and text not in used:
+            glyph = str(text)
+        else:
+            spare = [g for g in self.spare_glyphs if g not in used]
+            glyph = spare[0] if spare else '?'
+
+        self.glyphs[tile_type] = glyph
+        return glyph
+
+    def cell_char(self,z,level,cx,cy):
+        dominant,flags = self.summary(z,level,cx,cy)
+        if flags & MapPyramid.contains_exit:
+            return self.glyph(WorldTile.exit_point)
+        return self.glyph(dominant)
+
+class SpawnRule(object):
+
+    """ Density and spacing rule for one kind of spawn """
+
+    def __init__(
+                self,
+                kind,
+                tile_types,
+                density,
+                spacing=0,
+                max_count=None,
+                living=False
+                ):
+
+        self.kind = kind                # Key in PokeyWorld.spawns
+        self.tile_types = tile_types    # WorldTile types spawned on
+        self.density = density          # Fraction of free tiles per floor
+        self.spacing = spacing          # Min distance between same kind
+        self.max_count = max_count      # Per floor cap (None=no cap)
+        self.living = living            # Creature entity, else inert Spawn
+
+class SpawnEngine(object):
+
+    """ Bulk spawn placement.  Free tiles are indexed once per floor
+    and tile type, candidates are drawn at random and rejected in O(1)
+    against an occupancy bitmap and a Poisson-disc spacing grid """
+
+    default_rules = [
+        SpawnRule('chests',(WorldTile.dungeon,),0.01,6),
+        SpawnRule('traps',(WorldTile.dungeon,WorldTile.hallway),0.02,3),
+        SpawnRule('mobs',(WorldTile.dungeon,WorldTile.hallway,
+                            WorldTile.boss),0.03,2,living=True),
+        SpawnRule('npcs',(WorldTile.dungeon,),0.005,8,2,living=True)
+        ]
+
+    # Rejected draws allowed per requested spawn before giving up
+    max_attempts = 30
+
+    def __init__(self,world):
+
+        self.dim_x = world.dim_x
+        self.dim_y = world.dim_y
+        self.dim_z = world.dim_z
+
+        # One byte per grid position, 1 = occupied
+        self.occupied = bytearray(self.dim_x*self.dim_y*self.dim_z)
+        # (z,tile_type) -> array of linear grid indexes
+        self.free = {}
+
+        self.index_free_tiles(world.world_gen.grid,world.spawn_rules.values())
+
+    def index_free_tiles(self,grid,rules):
+        spawnable = set()
+        for rule in rules:
+            spawnable.update(rule.tile_types)
+
+        idx = 0
+        for z in range(self.dim_z):
+            for y in range(self.dim_y):
+                for x in range(self.dim_x):
+                    tile_type = grid[x,y,z][0]
+                    if tile_type in spawnable:
+                        key = (z,tile_type)
+                        if key not in self.free:
+                            self.free[key] = array('l')
+                        self.free[key].append(idx)
+                    idx += 1
+
+    def position(self,idx):
+        idx,x = divmod(idx,self.dim_x)
+        z,y = divmod(idx,self.dim_y)
+        return x,y,z
+
+    def index(self,loc):
+        x,y,z = loc
+        return (z*self.dim_y+y)*self.dim_x+x
+
+    def mark(self,loc,flag):
+        """ Sets (1) or clears (0) the occupancy of loc """
+        self.occupied[self.index(loc)] = flag
+
+    def spawn(self,rule):
+        """ Places rule.kind on every floor, returns (x,y,z) positions """
+
+        placed = []
+        for z in range(self.dim_z):
+            candidates = array('l')
+            for tile_type in rule.tile_types:
+                candidates.extend(self.free.get((z,tile_type),()))
+            placed.extend(self.spawn_floor(rule,candidates))
+        return placed
+
+    def spawn_floor(self,rule,candidates):
+        count = int(len(candidates)*rule.density)
+        if rule.max_count is not None:
+            count = min(count,rule.max_count)
+        if not count:
+            return []
+
+        # Poisson-disc grid, cells are small enough to hold one point so
+        # a spacing check only looks at the surrounding 5x5 cells
+        if rule.spacing:
+            cell = rule.spacing/math.sqrt(2)
+            disc = {}
+
+        placed = []
+        occupied = self.occupied
+        attempts = count*self.max_attempts
+        randrange = random.randrange
+        n = len(candidates)
+
+        while attempts and len(placed) < count:
+            attempts -= 1
+            idx = candidates[randrange(n)]
+            if occupied[idx]:
+                continue
+
+            x,y,z = self.position(idx)
+            if rule.spacing:
+                cx,cy = int(x/cell),int(y/cell)
+                if self.crowded(disc,cx,cy,x,y,rule.spacing):
+                    continue
+                disc[cx,cy] = (x,y)
+
+            occupied[idx] = 1
+            placed.append((x,y,z))
+
+        return placed
+
+    def crowded(self,disc,cx,cy,x,y,spacing):
+        limit = spacing*spacing
+        for nx in range(cx-2,cx+3):
+            for ny in range(cy-2,cy+3):
+                point = disc.get((nx,ny))
+                if point is not None:
+                    dx = point[0]-x
+                    dy = point[1]-y
+                    if dx*dx+dy*dy < limit:
+                        return True
+        return False
+
+class PokeySave(object):
+
+    """ Incremental SQLite save-games.  The game thread copies the
+    plain state of Tracked objects written to since the last save, the
+    background thread serializes it, diffs it against the checkpoint
+    and writes the rows which changed """
+
+    schema = [
+        'CREATE TABLE IF NOT EXISTS game_state '
+        '(key TEXT PRIMARY KEY, state TEXT)',
+        'CREATE TABLE IF NOT EXISTS entities '
+        '(uid INTEGER PRIMARY KEY, kind TEXT, state TEXT)',
+        'CREATE TABLE IF NOT EXISTS effects '
+        '(uid INTEGER, idx INTEGER, state TEXT, PRIMARY KEY (uid,idx))',
+        'CREATE TABLE IF NOT EXISTS tiles '
+        '(x INTEGER, y INTEGER, z INTEGER, type TEXT, PRIMARY KEY (x,y,z))',
+        'CREATE TABLE IF NOT EXISTS spawns '
+        '(x INTEGER, y INTEGER, z INTEGER, kind TEXT, PRIMARY KEY (x,y,z))'
+        ]
+
+    upsert_sql = {
+        'game_state':'INSERT OR REPLACE INTO game_state VALUES (?,?)',
+        'entities':'INSERT OR REPLACE INTO entities VALUES (?,?,?)',
+        'effects':'INSERT OR REPLACE INTO effects VALUES (?,?,?)',
+        'tiles':'INSERT OR REPLACE INTO tiles VALUES (?,?,?,?)',
+        'spawns':'INSERT OR REPLACE INTO spawns VALUES (?,?,?,?)'
+        }
+
+    delete_sql = {
+        'game_state':'DELETE FROM game_state WHERE key=?',
+        'entities':'DELETE FROM entities WHERE uid=?',
+        'effects':'DELETE FROM effects WHERE uid=? AND idx=?',
+        'spawns':'DELETE FROM spawns WHERE x=? AND y=? AND z=?'
+        }
+
+    # Only plain values are persisted, references and callables are skipped
+    saved_types = (bool,int,long,float,str,unicode,type(None))
+    game_attrs = ['turn','time_paused']
+
+    def __init__(self,game,db_path,logger,autosave_turns=10):
+
+        self.game = game
+        self.db_path = db_path
+        self.logger = logger
+        self.autosave_turns = autosave_turns
+
+        # (table,key) -> serialized state as of the last checkpoint,
+        # only touched by the writer thread (and load() while it idles)
+        self.checkpoint = {}
+        # uid -> tuple of its effects as of the last snapshot
+        self.saved = {}
+        # Entities and StatusEffects written to since the last snapshot
+        self.dirty = set()
+        Tracked.watchers.append(self.dirty)
+        self.write_failed = False
+        # The first save rewrites the file, rows from older games go
+        self.full_save = True
+
+        # Tile and spawn rows come from the world's change journal,
+        # subscribed from the first save so an unsaved game leaves it
+        # untrimmed
+        self.journal = game.world.journal
+        self.subscriber = 'pokeysave-{}'.format(id(self))
+        self.subscribed = False
+
+        self.queue = Queue.Queue()
+        self.worker = threading.Thread(
+                                       target=self.writer_loop,
+                                       name='pokeysave'
+                                       )
+        self.worker.daemon = True
+        self.worker.start()
+
+    def connect(self):
+        """ Opens a WAL mode connection, connections are per-thread """
+
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        for statement in self.schema:
+            conn.execute(statement)
+        conn.commit()
+        return conn
+
+    def plain_state(self,obj):
+        """ The plain attributes of obj, references and callables are
+        skipped """
+
+        return dict((k,v) for k,v in vars(obj).items()
+                        if isinstance(v,self.saved_types))
+
+    def snapshot(self):
+        """ Copies whatever changed since the last snapshot into a batch
+        for the writer thread """
+
+        if self.write_failed:
+            # The last write did not land, rewrite everything
+            self.logger.info('[*] Previous save failed, forcing full save')
+            self.full_save = True
+            self.write_failed = False
+
+        # A full save clears the tables in the same transaction, which
+        # also drops rows whose deletes were lost with a failed batch
+        reset = self.full_save
+        if reset:
+            self.saved = {}
+            self.full_save = False
+
+        dirty = set(self.dirty)
+        self.dirty.clear()
+        game = self.game
+
+        # (table,key,row columns,state), serialized by the writer
+        states = []
+        deletes = {}
+        upserts = {}
+
+        for attr in self.game_attrs:
+            states.append(('game_state',(attr,),(),getattr(game,attr,None)))
+
+        entities = list(game.entities)
+        if game.player is not None:
+            entities.append(game.player)
+        live = set([ent.uid for ent in entities])
+
+        for uid in [u for u in self.saved if u not in live]:
+            deletes.setdefault('entities',[]).append((uid,))
+            for idx in range(len(self.saved.pop(uid))):
+                deletes.setdefault('effects',[]).append((uid,idx))
+
+        # Untouched entities cost a lookup and a walk of their effects
+        for ent in entities:
+            uid = ent.uid
+            if uid not in self.saved or ent in dirty:
+                states.append((
+                            'entities',
+                            (uid,),
+                            (type(ent).__name__,),
+                            self.plain_state(ent)
+                            ))
+
+            effects = tuple(getattr(ent,'effects',()))
+            old = self.saved.get(uid,())
+            if effects!=old or dirty:
+                for idx,eff in enumerate(effects):
+                    if idx>=len(old) or old[idx] is not eff or eff in dirty:
+                        states.append((
+                                    'effects',
+                                    (uid,idx),
+                                    (),
+                                    self.plain_state(eff)
+                                    ))
+                for idx in range(len(effects),len(old)):
+                    deletes.setdefault('effects',[]).append((uid,idx))
+            self.saved[uid] = effects
+
+        rows = self.journal_rows(full=reset)
+        full_tiles = rows is None
+        if rows is not None:
+            tiles,spawns,vacated = rows
+            if tiles:
+                upserts['tiles'] = tiles
+            if spawns:
+                upserts['spawns'] = spawns
+            if vacated:
+                deletes['spawns'] = vacated
+
+        return {
+                'states':states,
+                'upserts':upserts,
+                'deletes':deletes,
+                'reset':reset,
+                'full_tiles':full_tiles
+                }
+
+    def journal_rows(self,full=False):
+        """ (tiles,spawns,vacated) rows changed since the last save, or
+        None when every tile and spawn must be written: on the first
+        save, after a failed write, or if the journal dropped changes
+        before this save saw them """
+
+        if not self.subscribed:
+            self.journal.subscribe(self.subscriber)
+            self.subscribed = True
+            return None
+
+        entries = self.journal.changes_since(self.subscriber)[0]
+        if full or entries is None:
+            return None
+
+        # Only the latest type per position is written
+        latest = {}
+        moved = set()
+        for seq,loc,old_type,new_type,changed in entries:
+            if changed & TileJournal.type_changed:
+                latest[loc] = new_type
+            if changed & TileJournal.occupant_changed:
+                moved.add(loc)
+        tiles = [loc+(json.dumps(t),) for loc,t in latest.items()]
+
+        # Creatures are saved as entities, only inert spawns get rows
+        occupants = self.game.world.occupants
+        spawns = []
+        vacated = []
+        for loc in moved:
+            ent = occupants.get(loc)
+            if isinstance(ent,Spawn):
+                spawns.append(loc+(ent.kind,))
+            else:
+                vacated.append(loc)
+        return tiles,spawns,vacated
+
+    def save(self,wait=False):
+        """ Queues a checkpoint of everything changed since the last
+        one, wait blocks until it has been written """
+
+        self.queue.put(self.snapshot())
+        if wait:
+            self.queue.join()
+
+    def autosave(self,turn):
+        if self.autosave_turns and turn % self.autosave_turns==0:
+            self.logger.debug('\tAutosave on turn {}'.format(turn))
+            self.save()
+
+    def writer_loop(self):
+        """ Background thread, writes queued batches until close() """
+
+        conn = None
+        while True:
+            batch = self.queue.get()
+            try:
+                if batch is None:
+                    break
+                if conn is None:
+                    conn = self.connect()
+                self.write_batch(conn,batch)
+            except Exception as e:
+                self.write_failed = True
+                self.logger.error('[*] Save Error {0}:{1}'.format(type(e),e))
+            finally:
+                self.queue.task_done()
+
+        if conn is not None:
+            conn.close()
+
+    def all_tile_rows(self):
+        """ Every tile, built on the writer thread.  Changes racing this
+        read are in the journal and land again with the next save """
+
+        world = self.game.world
+        grid = world.world_gen.grid
+        for z in range(world.dim_z):
+            for y in range(world.dim_y):
+                for x in range(world.dim_x):
+                    yield (x,y,z,json.dumps(grid[x,y,z][0]))
+
+    def all_spawn_rows(self):
+        """ Every inert spawn, built on the writer thread.  items()
+        copies the occupants in one step under the GIL """
+
+        for loc,ent in self.game.world.occupants.items():
+            if isinstance(ent,Spawn):
+                yield loc+(ent.kind,)
+
+    def diff_states(self,batch):
+        """ Serializes the batch states on the writer thread, returns
+        {table:[rows]} for those which differ from the checkpoint """
+
+        if batch['reset']:
+            self.checkpoint = {}
+
+        upserts = dict((t,list(r)) for t,r in batch['upserts'].items())
+        for table,key,columns,state in batch['states']:
+            state = json.dumps(state,sort_keys=True)
+            if self.checkpoint.get((table,key))!=state:
+                upserts.setdefault(table,[]).append(key+columns+(state,))
+                self.checkpoint[(table,key)] = state
+
+        for table,keys in batch['deletes'].items():
+            for key in keys:
+                self.checkpoint.pop((table,key),None)
+        return upserts
+
+    def write_batch(self,conn,batch):
+        upserts = self.diff_states(batch)
+        if not (upserts or batch['deletes'] or batch['reset']
+                or batch['full_tiles']):
+            return
+
+        with conn:
+            if batch['reset']:
+                for table in self.upsert_sql:
+                    conn.execute('DELETE FROM {}'.format(table))
+            if batch['full_tiles']:
+                conn.executemany(self.upsert_sql['tiles'],self.all_tile_rows())
+                conn.execute('DELETE FROM spawns')
+                conn.executemany(
+                                self.upsert_sql['spawns'],
+                                self.all_spawn_rows()
+                                )
+            for table,rows in upserts.items():
+                conn.executemany(self.upsert_sql[table],rows)
+            for table,keys in batch['deletes'].items():
+                conn.executemany(self.delete_sql[table],keys)
+
+    def load(self):
+        """ Reads the save file, returns a dict of game_state, entities,
+        effects, tiles and spawns states and resets the checkpoint to
+        match it """
+
+        self.queue.join()
+        conn = self.connect()
+        try:
+            # The checkpoint now mirrors the file, saves stay incremental
+            self.checkpoint = {}
+            self.full_save = False
+
+            game_state = {}
+            for key,state in conn.execute('SELECT * FROM game_state'):
+                game_state[key] = json.loads(state)
+                self.checkpoint[('game_state',(key,))] = state
+
+            entities = {}
+            for uid,kind,state in conn.execute('SELECT * FROM entities'):
+                entities[uid] = (kind,json.loads(state))
+                self.checkpoint[('entities',(uid,))] = state
+
+            effects = {}
+            for uid,idx,state in conn.execute(
+                                'SELECT * FROM effects ORDER BY uid,idx'):
+                effects.setdefault(uid,[]).append(json.loads(state))
+                self.checkpoint[('effects',(uid,idx))] = state
+
+            tiles = {}
+            for x,y,z,tile_type in conn.execute('SELECT * FROM tiles'):
+                tiles[x,y,z] = json.loads(tile_type)
+
+            spawns = {}
+            for x,y,z,kind in conn.execute('SELECT * FROM spawns'):
+                spawns[x,y,z] = kind
+        finally:
+            conn.close()
+
+        # Saved rows are matched to the restored objects by uid, whose
+        # effects are all resent once and diffed against the checkpoint
+        self.saved = dict((uid,(None,)*len(effects.get(uid,())))
+                            for uid in entities)
+
+        # Keep newly created entities clear of the restored uids
+        if entities:
+            Entity.uid_seq = itertools.count(max(entities)+1)
+
+        return {
+                'game_state':game_state,
+                'entities':entities,
+                'effects':effects,
+                'tiles':tiles,
+                'spawns':spawns
+                }
+
+    def restore(self,obj,state):
+        """ Applies a loaded state dict to obj """
+
+        for k,v in state.items():
+            setattr(obj,k,v)
+
+    def close(self):
+        if self.dirty in Tracked.watchers:
+            Tracked.watchers.remove(self.dirty)
+        if self.subscribed:
+            self.journal.unsubscribe(self.subscriber)
+            self.subscribed = False
+        self.queue.put(None)
+        self.worker.join()
+
+def world_gen_opts(conf):
+    """ The WorldGenerator flags in conf, as a plain (picklable) dict """
+
+    return {
+            'debug':conf.debug=='1',
+            'silent':conf.silent=='1',
+            'verbose':conf.verbose=='1',
+            'post_check':conf.auto_check=='1',
+            'path_alg':conf.path_alg
+            }
+
+def new_world_gen(opts,dims,logger):
+    return WorldGenerator(
+                        opts['debug'],opts['silent'],
+                        False,None,None,
+                        dims[0],
+                        dims[1],
+                        dims[2],
+                        0,opts['verbose'],logger,2,
+                        opts['post_check'],
+                        opts['path_alg']
+                        )
+
+def generate_floors(opts,dims,logger):
+    """ Yields (z,rows) for WorldExport, generating each floor when it
+    is reached as a one floor world and dropping it once its rows are
+    written.  Floors are generated independently of one another """
+
+    dim_x,dim_y,dim_z = dims
+    for z in range(dim_z):
+        # Only the rows generator holds the floor, until it is exhausted
+        world_gen = new_world_gen(opts,(dim_x,dim_y,1),logger)
+        rows = grid_rows(world_gen.grid,0,dim_x,dim_y)
+        del world_gen
+        yield z,rows
+
+def grid_rows(grid,z,dim_x,dim_y):
+    """ Yields (y,[tile types]) for floor z of grid, a row at a time """
+
+    for y in range(dim_y):
+        yield y,[grid[x,y,z][0] for x in range(dim_x)]
+
+def generate_world_gen(opts,dims):
+    """ PokeyServer process pool worker.  Returns (dims,WorldGenerator,
+    names of its logger attributes), loggers do not pickle so they are
+    cleared for the server to put its own back, or (dims,None,error) """
+
+    try:
+        world_gen = new_world_gen(
+                                opts,
+                                dims,
+                                logging.getLogger('pokeygame.worldgen')
+                                )
+    except Exception as e:
+        return dims,None,'{0}:{1}'.format(type(e),e)
+
+    loggers = [k for k,v in vars(world_gen).items()
+                if isinstance(v,logging.Logger)]
+    for k in loggers:
+        setattr(world_gen,k,None)
+    return dims,world_gen,loggers
+
+class PokeyServer(asyncore.dispatcher):
+
+    """ Hosts many game sessions in one asyncore event loop over a
+    line based (telnet friendly) protocol.  Sessions share read-only
+    worlds through the world cache, world generation runs in a process
+    pool and each session plays its own game on the shared world """
+
+    def __init__(
+                self,
+                name,
+                address=('127.0.0.1',4040),
+                conf_path='pokeygame.json',
+                workers=4,
+                backlog=128
+                ):
+
+        self.sock_map = {}
+        asyncore.dispatcher.__init__(self,map=self.sock_map)
+
+        self.name = name
+        self.conf = fw.PokeyConfig(conf_path,1,True)
+        self.config_init()
+        self.logger = fw.setup_logger(
+                                      self.name,
+                                      logging.DEBUG,
+                                      'tmp/server_log.txt'
+                                      )
+
+        self.sessions = set()
+        # (x,y,z) -> SharedWorld, least recently used first
+        self.world_cache = collections.OrderedDict()
+        self.pending = {}       # (x,y,z) -> sessions awaiting generation
+        self.finished = Queue.Queue()
+        # Generation is CPU bound, workers are processes.  Forked before
+        # the listening socket exists so they do not hold it open
+        self.pool = Pool(workers)
+        self.max_pending = workers*2
+        self.running = False
+
+        # A string address is a Unix socket path
+        if isinstance(address,basestring):
+            self.create_socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        else:
+            self.create_socket(socket.AF_INET,socket.SOCK_STREAM)
+            self.set_reuse_addr()
+        self.bind(address)
+        self.listen(backlog)
+        self.logger.info('[*] Serving on {}'.format(address))
+
+    def config_init(self):
+        """ Pulls the server limits, if they exist, from the config """
+
+        server_opts = [
+            ('max_dim_x',100),           # Largest world a client may ask
+            ('max_dim_y',100),           # for, per dimension
+            ('max_dim_z',20),
+            ('world_cache_size',8)       # Worlds kept after generation
+            ]
+
+        for opt in server_opts:
+            try:
+                setattr(self,opt[0],int(self.conf.conf_dict[opt[0]]))
+            except:
+                setattr(self,opt[0],opt[1])
+                continue
+
+    def default_dims(self):
+        return (int(self.conf.dim_x),int(self.conf.dim_y),int(self.conf.dim_z))
+
+    def check_dims(self,dims):
+        limits = (self.max_dim_x,self.max_dim_y,self.max_dim_z)
+        assert all(0 < d <= m for d,m in zip(dims,limits)), \
+                    'World size must be within 1-{0}x{1}x{2}'.format(*limits)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            sock,addr = pair
+            self.sessions.add(PokeySession(self,sock))
+            self.logger.debug('\tSession opened : {}'.format(addr))
+
+    def handle_error(self,e=None):
+        """ Also serves as the game error hook for cached PokeyWorlds """
+
+        if e is None:
+            self.logger.exception('[*] Server Error')
+        else:
+            self.logger.error('[*] Game Error {0}:{1}'.format(type(e),e))
+
+    def request_world(self,session,dims):
+        """ Hands the session its world, generating it on the worker
+        pool if it is not cached yet """
+
+        self.check_dims(dims)
+
+        if dims in self.world_cache:
+            # Mark as most recently used
+            world = self.world_cache.pop(dims)
+            self.world_cache[dims] = world
+            session.world_ready(world)
+        elif dims in self.pending:
+            self.pending[dims].append(session)
+        else:
+            assert len(self.pending) < self.max_pending, \
+                    'Server busy, try again shortly'
+            self.pending[dims] = [session]
+            self.pool.apply_async(
+                                generate_world_gen,
+                                (world_gen_opts(self.conf),dims),
+                                callback=self.finished.put
+                                )
+
+    def build_world(self,dims,world_gen,loggers):
+        """ Builds the SharedWorld for a generated grid, runs on the
+        event loop thread """
+
+        for attr in loggers:
+            setattr(world_gen,attr,self.logger)
+
+        conf = copy.copy(self.conf)
+        conf.dim_x,conf.dim_y,conf.dim_z = [str(d) for d in dims]
+        try:
+            return SharedWorld(PokeyWorld(self,conf,self.logger,world_gen))
+        except Exception as e:
+            self.handle_error(e)
+            return None
+
+    def drain_finished(self):
+        """ Delivers generated worlds on the event loop thread """
+
+        while True:
+            try:
+                dims,world_gen,info = self.finished.get_nowait()
+            except Queue.Empty:
+                break
+            if world_gen is None:
+                self.logger.error('[*] World Generation Error {}'.format(info))
+                world = None
+            else:
+                world = self.build_world(dims,world_gen,info)
+            if world is not None:
+                self.world_cache[dims] = world
+                # Sessions keep their own reference to evicted worlds
+                while len(self.world_cache) > self.world_cache_size:
+                    self.world_cache.popitem(last=False)
+            for session in self.pending.pop(dims,[]):
+                if session.connected:
+                    session.world_ready(world)
+
+    def serve_forever(self,poll=0.05):
+        self.running = True
+        try:
+            while self.running:
+                asyncore.loop(timeout=poll,map=self.sock_map,count=1)
+                self.drain_finished()
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        self.running = False
+        for session in list(self.sessions):
+            session.close()
+        self.close()
+        self.pool.terminate()
+        self.logger.info('[*] Server stopped')
+
+class SharedWorld(object):
+
+    """ The read-only part of a generated PokeyWorld which sessions
+    share: tile types, map rows, spawn placements and where each floor
+    is entered and left.  Tiles and rows are tuples, spawns is never
+    written after __init__, and every change a player makes is kept in
+    their PokeySession """
+
+    walkable = frozenset([
+                        WorldTile.dungeon,
+                        WorldTile.hallway,
+                        WorldTile.boss,
+                        WorldTile.door,
+                        WorldTile.exit_point
+                        ])
+
+    def __init__(self,world):
+
+        self.dim_x = world.dim_x
+        self.dim_y = world.dim_y
+        self.dim_z = world.dim_z
+
+        grid = world.world_gen.grid
+        glyph = world.pyramid.glyph
+
+        # tiles[z][y][x] : tile type, rows[z][y] : one glyph per tile
+        self.tiles = tuple(
+                        tuple(
+                            tuple(grid[x,y,z][0] for x in range(self.dim_x))
+                            for y in range(self.dim_y))
+                        for z in range(self.dim_z))
+        self.rows = tuple(
+                        tuple(''.join(glyph(t) for t in row)
+                            for row in floor)
+                        for floor in self.tiles)
+
+        # (x,y,z) -> spawn kind
+        self.spawns = dict((loc,ent.kind)
+                            for loc,ent in world.occupants.items())
+
+        self.starts = tuple(self.find_start(z) for z in range(self.dim_z))
+        self.exits = tuple(self.find_exit(z) for z in range(self.dim_z))
+
+    def tile(self,loc):
+        x,y,z = loc
+        return self.tiles[z][y][x]
+
+    def passable(self,loc):
+        x,y,z = loc
+        return (0<=x<self.dim_x and 0<=y<self.dim_y and 0<=z<self.dim_z
+                and self.tile(loc) in self.walkable)
+
+    def find_start(self,z):
+        """ First free walkable tile on floor z, None if there is none """
+
+        for y in range(self.dim_y):
+            for x in range(self.dim_x):
+                if self.passable((x,y,z)) and (x,y,z) not in self.spawns:
+                    return x,y,z
+        return None
+
+    def find_exit(self,z):
+        for y in range(self.dim_y):
+            for x in range(self.dim_x):
+                if self.tiles[z][y][x]==WorldTile.exit_point:
+                    return x,y,z
+        return None
+
+class PokeySession(asynchat.async_chat):
+
+    """ One connected player, all per-player state lives here.  The
+    world is shared, the player's position, the spawns they cleared and
+    the creatures they fought are not """
+
+    prompt = '> '
+    max_line = 1024
+
+    directions = {
+                'n':(0,-1),
+                's':(0,1),
+                'e':(1,0),
+                'w':(-1,0)
+                }
+
+    player_dmg = (1,8)
+    mob_dmg = (1,4)
+    trap_dmg = (1,10)
+
+    def __init__(self,server,sock):
+        asynchat.async_chat.__init__(self,sock,map=server.sock_map)
+        self.set_terminator('\n')
+
+        self.server = server
+        self.buffer = []
+        self.world = None
+        self.player = None
+        self.turn = 0
+        self.pos = None         # (x,y,z), None until a game starts
+        self.cleared = set()    # Spawn positions looted, sprung or killed
+        self.foes = {}          # (x,y,z) -> Creature fought so far
+        self.chests = 0
+
+        self.commands = {
+                        'help':self.do_help,
+                        'new':self.do_new,
+                        'look':self.do_look,
+                        'move':self.do_move,
+                        'attack':self.do_attack,
+                        'map':self.do_map,
+                        'wait':self.do_wait,
+                        'who':self.do_who,
+                        'quit':self.do_quit
+                        }
+
+        self.send_line('Welcome to {}, type help'.format(server.name))
+        self.push(self.prompt)
+
+    def send_line(self,text):
+        self.push('{}\r\n'.format(text))
+
+    def collect_incoming_data(self,data):
+        self.buffer.append(data)
+        if sum(len(b) for b in self.buffer) > self.max_line:
+            self.send_line('Line too long')
+            self.close_when_done()
+
+    def found_terminator(self):
+        line = ''.join(self.buffer).strip()
+        self.buffer = []
+        if not line:
+            self.push(self.prompt)
+            return
+
+        args = line.split()
+        cmd = self.commands.get(args[0].lower())
+        if cmd is None:
+            self.send_line('Unknown command : {}'.format(args[0]))
+        else:
+            try:
+                cmd(*args[1:])
+            except Exception as e:
+                self.send_line('Error : {}'.format(e))
+                self.server.handle_error(e)
+        if self.connected:
+            self.push(self.prompt)
+
+    def handle_close(self):
+        self.server.sessions.discard(self)
+        self.close()
+
+    def world_ready(self,world):
+        if world is None:
+            self.send_line('World generation failed')
+        else:
+            self.world = world
+            self.send_line('World ready ({0}x{1}x{2})'.format(
+                                    world.dim_x,world.dim_y,world.dim_z))
+            self.start_game()
+        self.push(self.prompt)
+
+    def start_game(self):
+        """ Starts this session's game on the first floor """
+
+        self.turn = 0
+        self.cleared = set()
+        self.foes = {}
+        self.chests = 0
+        self.pos = self.world.starts[0]
+        if self.pos is None:
+            self.send_line('There is no way into this world, try new')
+        else:
+            self.do_look()
+
+    def check_playing(self):
+        assert self.world is not None, 'No world yet, try new'
+        assert self.pos is not None, 'Game over, try new'
+
+    def spawn_at(self,loc):
+        """ The spawn kind at loc as this player sees it, or None """
+
+        if loc in self.cleared:
+            return None
+        return self.world.spawns.get(loc)
+
+    def step(self,direction):
+        try:
+            dx,dy = self.directions[direction]
+        except KeyError:
+            raise AssertionError('Direction must be one of n s e w')
+        x,y,z = self.pos
+        return x+dx,y+dy,z
+
+    def end_turn(self):
+        self.turn += 1
+        if self.player.dead():
+            self.send_line('You died on turn {}, try new'.format(self.turn))
+            self.pos = None
+
+    def do_help(self):
+        self.send_line('Commands : {}'.format(' '.join(sorted(self.commands))))
+        self.send_line('move n|s|e|w|down, attack n|s|e|w, map [floor]')
+
+    def do_new(self,*dims):
+        """ new <name> [x y z] """
+
+        assert dims, 'Usage : new <name> [x y z]'
+        if len(dims)==4:
+            world_dims = tuple(int(d) for d in dims[1:])
+        else:
+            world_dims = self.server.default_dims()
+
+        self.player = Player([],dims[0])
+        self.world = None
+        self.pos = None
+        self.server.request_world(self,world_dims)
+        if self.world is None:
+            self.send_line('Generating world...')
+
+    def do_look(self):
+        self.check_playing()
+        x,y,z = self.pos
+        self.send_line('Floor {0} at {1},{2}  health {3}  turn {4}'.format(
+                                z,x,y,self.player.health,self.turn))
+        for direction in sorted(self.directions):
+            kind = self.spawn_at(self.step(direction))
+            if kind is not None:
+                self.send_line('  {0} : {1}'.format(direction,kind))
+        if self.pos==self.world.exits[z]:
+            self.send_line('  A way down is here')
+
+    def do_move(self,direction=''):
+        self.check_playing()
+        world = self.world
+
+        if direction=='down':
+            z = self.pos[2]
+            assert self.pos==world.exits[z], 'There is no way down here'
+            if z+1 >= world.dim_z or world.starts[z+1] is None:
+                self.send_line('You escaped with {} chests!'.format(
+                                                            self.chests))
+                self.pos = None
+                return
+            self.pos = world.starts[z+1]
+        else:
+            loc = self.step(direction)
+            assert world.passable(loc), 'The way is blocked'
+            kind = self.spawn_at(loc)
+            assert kind!='mobs', 'A mob is in the way, attack it'
+            assert kind!='npcs', 'An npc is in the way, they nod at you'
+            self.pos = loc
+
+            if kind=='chests':
+                self.cleared.add(loc)
+                self.chests += 1
+                self.send_line('You open a chest')
+            elif kind=='traps':
+                self.cleared.add(loc)
+                dmg = combat.resolve(
+                            [(None,self.player,'combat',None,self.trap_dmg)])
+                self.send_line('A trap! You take {} damage'.format(
+                                                    dmg[0][2] if dmg else 0))
+
+        self.end_turn()
+        if self.pos is not None:
+            self.do_look()
+
+    def do_attack(self,direction=''):
+        self.check_playing()
+        loc = self.step(direction)
+        assert self.spawn_at(loc)=='mobs', 'There is nothing to attack there'
+
+        foe = self.foes.get(loc)
+        if foe is None:
+            foe = self.foes[loc] = Creature('mobs',loc)
+
+        results = combat.resolve([
+                    (self.player,foe,'combat',None,self.player_dmg),
+                    (foe,self.player,'combat',None,self.mob_dmg)
+                    ])
+        for attacker,target,dmg in results:
+            who = 'You hit' if attacker is self.player else 'The mob hits'
+            self.send_line('{0} for {1}'.format(who,dmg))
+
+        if foe.dead():
+            self.cleared.add(loc)
+            del self.foes[loc]
+            self.send_line('The mob dies')
+        self.end_turn()
+
+    def do_map(self,floor=None):
+        """ map [floor], the current floor by default """
+
+        assert self.world is not None, 'No world yet, try new'
+        if floor is None:
+            z = self.pos[2] if self.pos is not None else 0
+        else:
+            z = int(floor)
+        assert 0 <= z < self.world.dim_z, \
+                    'Floor must be 0-{}'.format(self.world.dim_z-1)
+
+        for y,row in enumerate(self.world.rows[z]):
+            if self.pos is not None and self.pos[1:]==(y,z):
+                x = self.pos[0]
+                row = row[:x]+'@'+row[x+1:]
+            self.send_line(row)
+
+    def do_wait(self):
+        self.check_playing()
+        self.end_turn()
+        self.send_line('Turn {}'.format(self.turn))
+
+    def do_who(self):
+        self.send_line('{} players online'.format(len(self.server.sessions)))
+
+    def do_quit(self):
+        self.send_line('Bye')
+        self.server.sessions.discard(self)
+        self.close_when_done()
+
 class Skill(object):
 
     """ Generic Skill Class """
@@ -521,14 +2505,147 @@ class RandomRoll(object):
 
         return self.hit, self.crit
 
-class Entity(object):
+class CombatResolver(object):
+
+    """ Resolves whole rounds of attacks in one pass.  Damage types and
+    elements are dispatched through tables compiled once, rather than
+    branching and building attribute names on every hit """
+
+    elements = ['fire','frost','magic','poison','death']
+    resist_difficulty = 75
+
+    def __init__(self):
+
+        # Element (or class named for one) -> its resist attrgetter
+        self.resist_getters = {}
+        for elem in self.elements:
+            self.resist_getters[elem] = operator.attrgetter('resist_'+elem)
+
+        # Attribute name -> compiled attrgetter
+        self.attr_getters = {}
+
+        self.handlers = {
+                        'combat':self.combat_damage,
+                        'magic':self.magic_damage
+                        }
+
+    def getter(self,attr):
+        try:
+            return self.attr_getters[attr]
+        except KeyError:
+            get = self.attr_getters[attr] = operator.attrgetter(attr)
+            return get
+
+    def resist_getter(self,elem):
+        """ elem may be an element name or a class named for one """
+
+        try:
+            return self.resist_getters[elem]
+        except KeyError:
+            name = getattr(elem,'__name__',elem)
+            get = self.resist_getters[elem] = self.resist_getters[name]
+            return get
+
+    def roll(self,entity,skill_level,difficulty,rand=random.random):
+        """ RandomRoll's hit range, returns (hit,crit).  RandomRoll's
+        crit check uses integer division and never crits, here the
+        crit range is crit_level percent of the top of the range """
+
+        level = getattr(entity,'level',1)
+        lower = max(0,skill_level-level)
+        upper = skill_level+(2*level)
+
+        roll = lower+int(rand()*(upper-lower+1))
+        crit_range = getattr(entity,'crit_level',0)/100.0
+        crit = upper > 0 and float(roll)/upper > (1-crit_range)
+        return roll >= difficulty, crit
+
+    def resist_roll(self,entity,elem):
+        return self.roll(
+                        entity,
+                        self.resist_getter(elem)(entity),
+                        self.resist_difficulty
+                        )
+
+    def combat_damage(self,attacker,target,elem,dmg_rng,rand):
+        dmg = dmg_rng[0]+int(rand()*(dmg_rng[1]-dmg_rng[0]+1))
+        if attacker is not None:
+            dmg += attacker.attack
+        return max(0,dmg-target.defense)
+
+    def magic_damage(self,attacker,target,elem,dmg_rng,rand):
+        if elem is None:
+            succ = crit = False
+        else:
+            succ,crit = self.roll(
+                                target,
+                                self.resist_getter(elem)(target),
+                                self.resist_difficulty,
+                                rand
+                                )
+
+        # Resisted with a crit takes nothing, a partial resist the minimum
+        if succ and crit:
+            return 0
+        elif succ or crit:
+            return dmg_rng[0]
+        return dmg_rng[0]+int(rand()*(dmg_rng[1]-dmg_rng[0]+1))
+
+    def resolve(self,attacks):
+        """ Resolves a round of (attacker,target,type,element,range)
+        attacks.  The round is simultaneous, damage is summed per target
+        and applied once at the end.  Returns [(attacker,target,dmg)] """
+
+        handlers = self.handlers
+        rand = random.random
+        results = []
+        totals = {}
+
+        for attacker,target,dmg_type,elem,dmg_rng in attacks:
+            if not target.living:
+                continue
+            try:
+                handler = handlers[dmg_type]
+            except KeyError:
+                raise AssertionError("Invalid dmg type : {}".format(dmg_type))
+
+            dmg = handler(attacker,target,elem,dmg_rng,rand)
+            totals[target] = totals.get(target,0)+dmg
+            results.append((attacker,target,dmg))
+
+        for target,dmg in totals.items():
+            target.health -= dmg
+            target.living_check()
+
+        return results
+
+combat = CombatResolver()
+
+class Tracked(object):
+
+    """ Records attribute writes for incremental saves, every set in
+    Tracked.watchers collects the objects written to """
+
+    watchers = []
+
+    def __setattr__(self,name,value):
+        object.__setattr__(self,name,value)
+        for dirty in Tracked.watchers:
+            dirty.add(self)
+
+class Entity(Tracked):
 
     """ General attributes/methods for Player/NPC Entities """
 
+    uid_seq = itertools.count(1)     # Save-game row keys
+    base_health = 100
+
     def __init__(self):
+        self.uid = next(Entity.uid_seq)
         self.trigger_seal = False    # Set to true for Player types
         self.lootable = True
         self.living = True
+        self.health = self.base_health
 
         # Numeric attributes
         for item in [
@@ -549,38 +2666,24 @@ class Entity(object):
 
         assert dmg_dict['range'] is not None, 'Invalid damage range'
 
-        if dmg_dict['type']=='combat':
-            pass
-        elif dmg_dict['type']=='magic':
-            if dmg_dict['element'] is not None:
-                succ,crit = self.resist_roll(dmg_dict['element'])
-        else:
-            raise AssertionError("Invalid dmg type : {}".format(dmg_dict))
-
-    def apply_spell_damage(elem=None,dmg_rng=None):
-
-        if elem is not None:
-
-            assert dmg_rng is not None, 'Invalid damage range'
-            succ,crit = self.resist_roll(elem)
-
-        else:
-            succ = crit = False
+        return combat.resolve([(
+                                dmg_dict.get('attacker'),
+                                self,
+                                dmg_dict['type'],
+                                dmg_dict.get('element'),
+                                dmg_dict['range']
+                                )])
 
-        if succ and crit:
-            return False
-        elif succ or crit:
-            dmg = dmg_rng[0]
-        else:
-            dmg = random.randint(dmg_rng)
+    def apply_spell_damage(self,elem=None,dmg_rng=None):
+        """ Takes one spell hit through the CombatResolver, returns the
+        damage dealt """
 
-        self.health -= dmg
-        self.living_check()
+        assert dmg_rng is not None, 'Invalid damage range'
+        results = combat.resolve([(None,self,'magic',elem,dmg_rng)])
+        return results[0][2] if results else 0
 
     def resist_roll(self,elem):
-        resist = getattr(self,'resist_{}'.format(elem.__name__))
-
-        return  RandomRoll(self, resist)
+        return combat.resist_roll(self,elem)
 
     def status_effect(self,effect):
 
@@ -649,10 +2752,10 @@ class Entity(object):
         # If a resist attribute is passed, the player
         # will attempt to resist the damage
         if resist is not None:
-            succ,bonus = RandomRoll(
+            succ,bonus = combat.roll(
                                     self,
-                                    getattr(self,resist),
-                                    75
+                                    combat.getter(resist)(self),
+                                    CombatResolver.resist_difficulty
                                     )
         else:
             succ = bonus = False
@@ -666,14 +2769,14 @@ class Entity(object):
         elif succ:
                 dmg = dmg/2
 
-        att_value = getattr(self,dmg_att)
+        att_value = getattr(self,dmg_attr)
 
         if percent:
             # Convert dmg to a percentage and deduct from attribute
             p = dmg/100
-            setattr(self,dmg_att,att_value-(p*att_value))
+            setattr(self,dmg_attr,att_value-(p*att_value))
         else:
-            setattr(self,dmg_att,getattr(self,dmg_att)-dmg)
+            setattr(self,dmg_attr,att_value-dmg)
 
     def proc_status_effect(
                             self,
@@ -687,10 +2790,10 @@ class Entity(object):
         # will attempt to resist the status change
 
         if resist is not None:
-            succ,bonus = RandomRoll(
+            succ,bonus = combat.roll(
                                     self,
-                                    getattr(self,resist),
-                                    75
+                                    combat.getter(resist)(self),
+                                    CombatResolver.resist_difficulty
                                     )
         else:
             succ = False
@@ -700,6 +2803,29 @@ class Entity(object):
         else:
             setattr(self,status_att,status_val)
 
+class Spawn(object):
+
+    """ An inert chest or trap placed by the SpawnEngine.  These are
+    not entities, PokeySave stores them as (x,y,z,kind) rows """
+
+    __slots__ = ('kind','x','y','z')
+
+    def __init__(self,kind,loc):
+
+        self.kind = kind    # SpawnRule kind (i.e. 'chests')
+        self.x,self.y,self.z = loc
+
+class Creature(Entity):
+
+    """ A mob or npc placed by the SpawnEngine """
+
+    def __init__(self,kind,loc):
+
+        super(Creature,self).__init__()
+
+        self.kind = kind    # SpawnRule kind (i.e. 'mobs')
+        self.x,self.y,self.z = loc
+
 class Player(Entity):
 
     """ General Player Entity """
@@ -715,7 +2841,7 @@ class Player(Entity):
                 p_sex=0
                 ):
 
-        Super(Player,self).__init__()
+        super(Player,self).__init__()
 
         self.trigger_seal = True
 
@@ -776,7 +2902,7 @@ class ColorIze(object):
 
         return
 
-class StatusEffect(object):
+class StatusEffect(Tracked):
     """ Temporary status effects on players """
 
     def __init__(